@@ -0,0 +1,125 @@
+"""
+Measure event-loop lag under a mixed read/write/scan load, issued from
+coroutines either by calling a synchronous LSM handle directly or by awaiting
+an AsyncLSM. Lag is how late a 1ms ticker coroutine wakes up.
+
+    python benchmarks/async_lag.py --clients 50 --duration 3
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import lsm
+
+
+def populate(filename, nkeys, value):
+    with lsm.LSM(filename) as db:
+        db.bulk_load((b'k%010d' % i, value) for i in range(nkeys))
+
+
+async def ticker(lags, stop, interval=0.001):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+
+
+async def sync_client(db, nkeys, value, scan_size, counts, stop):
+    rand = random.Random().random
+    while not stop.is_set():
+        key = b'k%010d' % int(rand() * nkeys)
+        r = rand()
+        if r < 0.7:
+            db.fetch(key)
+        elif r < 0.95:
+            db.insert(key, value)
+        else:
+            list(db.scan(key, limit=scan_size))
+        counts[0] += 1
+        await asyncio.sleep(0)
+
+
+async def async_client(db, nkeys, value, scan_size, counts, stop):
+    rand = random.Random().random
+    while not stop.is_set():
+        key = b'k%010d' % int(rand() * nkeys)
+        r = rand()
+        if r < 0.7:
+            await db.fetch(key)
+        elif r < 0.95:
+            await db.insert(key, value)
+        else:
+            n = 0
+            async for _ in db.scan(key, chunk_size=scan_size):
+                n += 1
+                if n == scan_size:
+                    break
+        counts[0] += 1
+
+
+async def run(mode, filename, args, value):
+    stop = asyncio.Event()
+    lags = []
+    counts = [0]
+    if mode == 'sync':
+        db = lsm.LSM(filename)
+        client = sync_client
+    else:
+        db = lsm.AsyncLSM(filename, readers=args.readers)
+        await db.open()
+        client = async_client
+
+    tasks = [asyncio.ensure_future(ticker(lags, stop))]
+    tasks.extend(
+        asyncio.ensure_future(client(db, args.keys, value, args.scan_size,
+                                     counts, stop))
+        for _ in range(args.clients))
+    start = time.time()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.time() - start
+
+    if mode == 'sync':
+        db.close()
+    else:
+        await db.close()
+
+    lags.sort()
+
+    def pct(p):
+        return lags[min(len(lags) - 1, int(len(lags) * p))] * 1e3
+    return counts[0] / elapsed, pct(0.5), pct(0.99), lags[-1] * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--scan-size', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    value = b'x' * args.value_size
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        populate(filename, args.keys, value)
+        print('%-8s %12s %14s %14s %14s' % (
+            'mode', 'ops/s', 'lag p50 (ms)', 'lag p99 (ms)', 'lag max (ms)'))
+        for mode in ('sync', 'async'):
+            result = asyncio.run(run(mode, filename, args, value))
+            print('%-8s %12d %14.3f %14.3f %14.3f' % ((mode,) + result))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare database file size, insert throughput and range-scan throughput with
+and without page compression, using repetitive JSON values.
+
+    python benchmarks/compression.py --keys 200000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import lsm
+
+
+def make_value(i):
+    return json.dumps({
+        'id': i,
+        'name': 'user-%s' % (i % 1000),
+        'email': 'user-%s@example.com' % (i % 1000),
+        'tags': ['alpha', 'beta', 'gamma', 'delta'],
+        'active': i % 2 == 0,
+        'score': i % 97,
+    })
+
+
+def run(filename, compression, nkeys):
+    values = [make_value(i) for i in range(nkeys)]
+    with lsm.LSM(filename, compression=compression) as db:
+        start = time.time()
+        for i, value in enumerate(values):
+            db[b'k%010d' % i] = value
+        db.flush()
+        while db.work(1, 4096):
+            pass
+        db.checkpoint(0)
+        insert_time = time.time() - start
+        pages_written = db.pages_written()
+
+    with lsm.LSM(filename, compression=compression) as db:
+        start = time.time()
+        nrows = sum(1 for _ in db)
+        scan_time = time.time() - start
+        assert nrows == nkeys
+
+    return {
+        'file_size': os.path.getsize(filename),
+        'pages_written': pages_written,
+        'insert_per_sec': nkeys / insert_time,
+        'scan_per_sec': nkeys / scan_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=200000)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%-12s %12s %14s %14s %14s' % (
+            'compression', 'file size', 'pages written', 'inserts/s',
+            'scanned/s'))
+        for compression in (None, 'zlib'):
+            filename = os.path.join(tmp_dir, '%s.ldb' % compression)
+            result = run(filename, compression, args.keys)
+            print('%-12s %12d %14d %14d %14d' % (
+                compression, result['file_size'], result['pages_written'],
+                result['insert_per_sec'], result['scan_per_sec']))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Measure durable commits per second (write_safety=SAFETY_FULL) against the
+number of writing threads, committing one transaction per write on a
+shared handle, or through a GroupCommit coordinator.
+
+    python benchmarks/group_commit.py --threads 1 2 4 8 16 32
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import lsm
+
+
+def direct(db, lock, thread_id, ncommits, value):
+    # Transactions belong to the handle, so threads sharing one must not
+    # interleave them.
+    for i in range(ncommits):
+        batch = lsm.WriteBatch()
+        batch[b't%04d-%08d' % (thread_id, i)] = value
+        with lock:
+            db.write(batch)
+
+
+def grouped(committer, thread_id, ncommits, value):
+    for i in range(ncommits):
+        with committer.transaction() as batch:
+            batch[b't%04d-%08d' % (thread_id, i)] = value
+
+
+def run(filename, mode, nthreads, ncommits, value, window):
+    with lsm.LSM(filename, write_safety=lsm.SAFETY_FULL) as db:
+        if mode == 'direct':
+            lock = threading.Lock()
+            target, args = direct, (db, lock)
+        else:
+            committer = db.group_commit(window=window)
+            target, args = grouped, (committer,)
+        threads = [threading.Thread(target=target,
+                                    args=args + (i, ncommits, value))
+                   for i in range(nthreads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return nthreads * ncommits / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--threads', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument('--commits', type=int, default=200,
+                        help='commits per thread')
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--window', type=float, default=0.001)
+    args = parser.parse_args()
+
+    value = b'x' * args.value_size
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%-8s %16s %16s' % ('threads', 'direct (c/s)', 'group (c/s)'))
+        for nthreads in args.threads:
+            results = []
+            for mode in ('direct', 'group'):
+                filename = os.path.join(tmp_dir, '%s-%s.ldb' % (mode,
+                                                                nthreads))
+                results.append(run(filename, mode, nthreads, args.commits,
+                                   value, args.window))
+            print('%-8d %16d %16d' % ((nthreads,) + tuple(results)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
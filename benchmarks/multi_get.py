@@ -0,0 +1,62 @@
+"""
+Compare multi-key lookups in caller order against lookups sorted internally
+by LSM.get_bulk(), for several batch sizes. Half of the requested keys are
+missing.
+
+    python benchmarks/multi_get.py --sizes 1000 100000 1000000
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import lsm
+
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    fn(*args, **kwargs)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=1000000,
+                        help='number of keys in the database')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 100000, 1000000])
+    parser.add_argument('--value-size', type=int, default=100)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        value = b'x' * args.value_size
+        db = lsm.LSM(filename)
+        db.bulk_load((b'k%010d' % i, value) for i in range(0, args.keys * 2,
+                                                           2))
+
+        print('%-10s %14s %14s %14s %14s' % (
+            'keys', 'fetch_bulk', 'get_bulk', 'get_bulk',
+            'exists_bulk'))
+        print('%-10s %14s %14s %14s %14s' % (
+            '', '(caller)', '(caller)', '(sorted)', '(sorted)'))
+        for size in args.sizes:
+            keys = [b'k%010d' % random.randrange(args.keys * 2)
+                    for _ in range(size)]
+            results = [
+                timed(db.fetch_bulk, keys),
+                timed(db.get_bulk, keys, sort_keys=False),
+                timed(db.get_bulk, keys),
+                timed(db.exists_bulk, keys)]
+            print('%-10d %s' % (size, ' '.join(
+                '%14s' % ('%d/s' % (size / t)) for t in results)))
+        db.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
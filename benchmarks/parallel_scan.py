@@ -0,0 +1,62 @@
+"""
+Measure full-scan throughput of LSM.parallel_scan() as the number of
+workers increases, using threads and processes.
+
+    python benchmarks/parallel_scan.py --keys 1000000 --workers 1 2 4 8
+"""
+import argparse
+import operator
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import lsm
+
+
+def populate(filename, nkeys, value_size):
+    value = b'x' * value_size
+    with lsm.LSM(filename) as db:
+        db.bulk_load((b'k%010d' % i, value) for i in range(nkeys))
+
+
+def total_size(records):
+    n = 0
+    for key, value in records:
+        n += len(value)
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        populate(filename, args.keys, args.value_size)
+        print('%-8s %16s %16s' % ('workers', 'threads (rec/s)',
+                                  'processes (rec/s)'))
+        with lsm.LSM(filename) as db:
+            for nworkers in args.workers:
+                results = []
+                for processes in (False, True):
+                    start = time.time()
+                    nbytes = db.parallel_scan(total_size, nworkers,
+                                              reduce=operator.add,
+                                              processes=processes)
+                    results.append(args.keys / (time.time() - start))
+                    assert nbytes == args.keys * args.value_size
+                print('%-8d %16d %16d' % ((nworkers,) + tuple(results)))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
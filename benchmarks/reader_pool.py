@@ -0,0 +1,54 @@
+"""
+Compare point-lookup throughput of one LSM handle with a ReaderPool of
+read-only handles in several worker processes.
+
+    python benchmarks/reader_pool.py --processes 1 2 4 8
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import lsm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=200000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        value = b'x' * args.value_size
+        with lsm.LSM(filename) as db:
+            db.bulk_load((b'k%010d' % i, value) for i in range(args.keys))
+        keys = [b'k%010d' % random.randrange(args.keys)
+                for _ in range(args.lookups)]
+
+        print('%-12s %14s' % ('processes', 'lookups/s'))
+        with lsm.LSM(filename, readonly=True, mmap=True) as db:
+            start = time.time()
+            db.fetch_bulk(keys)
+            print('%-12s %14d' % ('(handle)',
+                                  args.lookups / (time.time() - start)))
+        for nprocesses in args.processes:
+            with lsm.ReaderPool(filename, processes=nprocesses) as readers:
+                start = time.time()
+                readers.fetch_bulk(keys, chunk_size=10000)
+                print('%-12d %14d' % (nprocesses,
+                                      args.lookups / (time.time() - start)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
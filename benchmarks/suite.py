@@ -0,0 +1,390 @@
+"""
+Benchmark suite covering the tunable options, access patterns and data sizes.
+
+Each configuration (a set of options, a number of keys and a value size) is
+run in a fresh process, against a fresh database, through these workloads:
+
+    seq_insert     insert keys in order, in transactions of --batch keys
+    random_insert  insert the same keys in random order
+    fetch          fetch random keys, half of which are missing
+    fetch_bulk     fetch_bulk() of --batch random keys per call
+    scan_forward   iterate over the whole database
+    scan_reverse   iterate over the whole database in reverse
+    delete         delete random keys
+    delete_range   delete_range() over runs of --batch keys
+
+For each workload the suite records the throughput, the p50 and p99
+latency, the pages read and written, the file size and the peak RSS of the
+process. Latencies are per operation for point operations, per call for
+fetch_bulk and delete_range, and per --batch rows for scans.
+
+By default, each option listed in OPTIONS is varied on its own from the
+library defaults; use --option to choose the values and --full-matrix to
+run every combination.
+
+    python benchmarks/suite.py run --keys 100000 --output base.json
+    python benchmarks/suite.py run --option autoflush=1024,8192 \\
+        --value-sizes 100 4096 --output new.json
+    python benchmarks/suite.py compare base.json new.json --threshold 0.1
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import lsm
+
+
+# Values compared against the library defaults when no --option is given.
+OPTIONS = {
+    'autoflush': [4096],
+    'autocheckpoint': [8192],
+    'automerge': [8],
+    'mmap': [0],
+    'write_safety': [lsm.SAFETY_OFF],
+    'transaction_log': [False],
+    'page_size': [8192],
+    'block_size': [4096],
+}
+
+WORKLOADS = ('seq_insert', 'random_insert', 'fetch', 'fetch_bulk',
+             'scan_forward', 'scan_reverse', 'delete', 'delete_range')
+
+# Metrics compared by "compare", and whether higher values are better.
+METRICS = {
+    'ops_per_sec': True,
+    'p50_us': False,
+    'p99_us': False,
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.))]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KB elsewhere.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def make_key(i):
+    return b'k%010d' % i
+
+
+class Timer(object):
+    def __init__(self):
+        self.latencies = []
+        self.units = 0
+
+    def time(self, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+
+def insert(db, keys, value, batch, timer):
+    for i in range(0, len(keys), batch):
+        db.begin()
+        for key in keys[i:i + batch]:
+            timer.time(db.insert, key, value)
+        # Attribute the commit to the last insert of the batch.
+        start = time.perf_counter()
+        db.commit()
+        timer.latencies[-1] += time.perf_counter() - start
+    timer.units = len(keys)
+
+
+def fetch(db, keys, rand, timer):
+    def fetch_one(key):
+        try:
+            return db.fetch(key)
+        except KeyError:
+            return None
+
+    for _ in range(len(keys)):
+        # Even numbers are stored, odd numbers are missing.
+        timer.time(fetch_one, make_key(rand.randrange(len(keys) * 2)))
+    timer.units = len(keys)
+
+
+def fetch_bulk(db, keys, batch, rand, timer):
+    for _ in range(0, len(keys), batch):
+        timer.time(db.fetch_bulk, [make_key(rand.randrange(len(keys) * 2))
+                                   for _ in range(batch)])
+    timer.units = len(keys)
+
+
+def scan(db, reverse, batch, timer):
+    iterator = iter(reversed(db) if reverse else db)
+    start = time.perf_counter()
+    n = 0
+    for _ in iterator:
+        n += 1
+        if n % batch == 0:
+            now = time.perf_counter()
+            timer.latencies.append(now - start)
+            start = now
+    timer.units = n
+
+
+def delete(db, keys, rand, batch, timer):
+    victims = rand.sample(keys, len(keys) // 2)
+    for i in range(0, len(victims), batch):
+        db.begin()
+        for key in victims[i:i + batch]:
+            timer.time(db.delete, key)
+        start = time.perf_counter()
+        db.commit()
+        timer.latencies[-1] += time.perf_counter() - start
+    timer.units = len(victims)
+
+
+def delete_range(db, keys, batch, timer):
+    # Keys are even numbers, so each range holds batch / 2 keys.
+    for i in range(0, len(keys) * 2, batch):
+        timer.time(db.delete_range, make_key(i - 1), make_key(i + batch))
+    timer.units = len(keys)
+
+
+def run_workload(name, filename, options, keys, value, batch, seed):
+    rand = random.Random(seed)
+    timer = Timer()
+    with lsm.LSM(filename, **options) as db:
+        pages_read = db.pages_read()
+        pages_written = db.pages_written()
+        start = time.perf_counter()
+        if name == 'seq_insert':
+            insert(db, keys, value, batch, timer)
+        elif name == 'random_insert':
+            shuffled = list(keys)
+            rand.shuffle(shuffled)
+            insert(db, shuffled, value, batch, timer)
+        elif name == 'fetch':
+            fetch(db, keys, rand, timer)
+        elif name == 'fetch_bulk':
+            fetch_bulk(db, keys, batch, rand, timer)
+        elif name in ('scan_forward', 'scan_reverse'):
+            scan(db, name == 'scan_reverse', batch, timer)
+        elif name == 'delete':
+            delete(db, keys, rand, batch, timer)
+        elif name == 'delete_range':
+            delete_range(db, keys, batch, timer)
+        elapsed = time.perf_counter() - start
+        pages_read = db.pages_read() - pages_read
+        pages_written = db.pages_written() - pages_written
+
+    return {
+        'workload': name,
+        'ops': timer.units,
+        'seconds': elapsed,
+        'ops_per_sec': timer.units / elapsed if elapsed else 0.,
+        'p50_us': percentile(timer.latencies, 50) * 1e6,
+        'p99_us': percentile(timer.latencies, 99) * 1e6,
+        'pages_read': pages_read,
+        'pages_written': pages_written,
+        'file_size': os.path.getsize(filename),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_config(config):
+    # Runs in its own process, so peak RSS and caches are not shared
+    # between configurations.
+    options = config['options']
+    keys = [make_key(i) for i in range(0, config['keys'] * 2, 2)]
+    value = b'v' * config['value_size']
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        for name in config['workloads']:
+            if name == 'random_insert':
+                # Measure random inserts into a new database; the remaining
+                # workloads run against it.
+                os.unlink(filename)
+                for suffix in ('-log', '-shm'):
+                    if os.path.exists(filename + suffix):
+                        os.unlink(filename + suffix)
+            result = run_workload(name, filename, options, keys, value,
+                                  config['batch'], config['seed'])
+            result.update(options=options, keys=config['keys'],
+                          value_size=config['value_size'])
+            results.append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def parse_options(values):
+    options = {}
+    for value in values or ():
+        name, _, choices = value.partition('=')
+        if name not in OPTIONS:
+            raise SystemExit('Unknown option %r, expected one of: %s' % (
+                name, ', '.join(sorted(OPTIONS))))
+        options[name] = [int(choice) for choice in choices.split(',')]
+    return options or OPTIONS
+
+
+def option_sets(options, full_matrix):
+    if full_matrix:
+        names = sorted(options)
+        return [dict(zip(names, values)) for values in
+                itertools.product(*[options[name] for name in names])]
+    sets = [{}]
+    for name in sorted(options):
+        sets.extend({name: value} for value in options[name])
+    return sets
+
+
+def config_label(result):
+    options = ','.join('%s=%s' % item for item in
+                       sorted(result['options'].items())) or 'defaults'
+    return '%s keys=%s value=%s' % (options, result['keys'],
+                                    result['value_size'])
+
+
+def run(args):
+    workloads = args.workloads or WORKLOADS
+    for name in workloads:
+        if name not in WORKLOADS:
+            raise SystemExit('Unknown workload %r' % name)
+    if 'seq_insert' not in workloads and 'random_insert' not in workloads:
+        raise SystemExit('At least one insert workload is required.')
+
+    configs = [{'options': options, 'keys': nkeys, 'value_size': size,
+                'workloads': workloads, 'batch': args.batch,
+                'seed': args.seed}
+               for options in option_sets(parse_options(args.option),
+                                          args.full_matrix)
+               for nkeys in args.keys
+               for size in args.value_sizes]
+
+    results = []
+    print('%-52s %-14s %12s %10s %10s %10s %10s' % (
+        'configuration', 'workload', 'ops/s', 'p50 (us)', 'p99 (us)',
+        'pg read', 'pg written'))
+    for config in configs:
+        pool = multiprocessing.Pool(1)
+        try:
+            config_results = pool.apply(run_config, (config,))
+        finally:
+            pool.terminate()
+        for result in config_results:
+            print('%-52s %-14s %12d %10.1f %10.1f %10d %10d' % (
+                config_label(result), result['workload'],
+                result['ops_per_sec'], result['p50_us'], result['p99_us'],
+                result['pages_read'], result['pages_written']))
+            sys.stdout.flush()
+        results.extend(config_results)
+
+    report = {
+        'meta': {
+            'lsm': lsm.__file__,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'args': sys.argv[1:],
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+
+
+def compare(args):
+    def load(filename):
+        with open(filename) as fh:
+            return dict(((config_label(result), result['workload']), result)
+                        for result in json.load(fh)['results'])
+
+    base, new = load(args.base), load(args.new)
+    regressions = 0
+    print('%-52s %-14s %-12s %12s %12s %8s' % (
+        'configuration', 'workload', 'metric', 'base', 'new', 'change'))
+    for key in sorted(set(base) & set(new)):
+        for metric, higher_is_better in sorted(METRICS.items()):
+            old_value, new_value = base[key][metric], new[key][metric]
+            if not old_value:
+                continue
+            change = (new_value - old_value) / float(old_value)
+            regressed = (-change if higher_is_better else change) > \
+                args.threshold
+            regressions += regressed
+            if regressed or args.verbose:
+                print('%-52s %-14s %-12s %12.1f %12.1f %+7.1f%% %s' % (
+                    key[0], key[1], metric, old_value, new_value,
+                    change * 100, 'REGRESSION' if regressed else ''))
+
+    missing = set(base) ^ set(new)
+    if missing:
+        print('%d results only appear in one of the runs.' % len(missing))
+    print('%d regressions beyond %d%%.' % (regressions,
+                                            args.threshold * 100))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--keys', type=int, nargs='+', default=[50000])
+    run_parser.add_argument('--value-sizes', type=int, nargs='+',
+                            default=[100, 1000])
+    run_parser.add_argument('--option', action='append',
+                            help='option and comma-separated values to '
+                            'compare, e.g. autoflush=1024,4096')
+    run_parser.add_argument('--full-matrix', action='store_true',
+                            help='run every combination of option values')
+    run_parser.add_argument('--workloads', nargs='+',
+                            help='subset of: %s' % ' '.join(WORKLOADS))
+    run_parser.add_argument('--batch', type=int, default=100)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='write results to this JSON '
+                            'file')
+
+    compare_parser = commands.add_parser(
+        'compare', help='flag regressions between two runs')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative change reported as a '
+                                'regression (default 0.1)')
+    compare_parser.add_argument('--verbose', action='store_true',
+                                help='show all metrics, not only '
+                                'regressions')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
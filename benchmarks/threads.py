@@ -0,0 +1,120 @@
+"""
+Measure read throughput from several threads while a maintenance thread
+writes, merges and checkpoints the same database file.
+
+Run this script against two builds of the extension to compare them, e.g.:
+
+    python benchmarks/threads.py --threads 1 2 4 8
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import lsm
+
+
+def populate(filename, nkeys, value_size):
+    value = b'x' * value_size
+    with lsm.LSM(filename) as db:
+        with db.transaction():
+            for i in range(nkeys):
+                db[b'k%010d' % i] = value
+        db.flush()
+        while db.work(1, 4096):
+            pass
+        db.checkpoint(0)
+
+
+def maintenance(filename, value_size, stop):
+    # The maintenance thread owns its own handle and performs all merging
+    # and checkpointing explicitly, as the LSM docstring recommends.
+    value = b'y' * value_size
+    i = 0
+    with lsm.LSM(filename, autowork=0) as db:
+        while not stop.is_set():
+            with db.transaction():
+                for _ in range(1000):
+                    db[b'w%010d' % i] = value
+                    i += 1
+            try:
+                db.work(2, 1024)
+            except RuntimeError:
+                pass
+            db.checkpoint(0)
+
+
+def reader(db, nkeys, counts, idx, stop):
+    rand = random.Random(idx).randrange
+    fetch = db.fetch
+    n = 0
+    while not stop.is_set():
+        for _ in range(100):
+            fetch(b'k%010d' % rand(nkeys))
+        n += 100
+    counts[idx] = n
+
+
+def run(filename, nthreads, nkeys, value_size, duration, shared):
+    stop = threading.Event()
+    counts = [0] * nthreads
+    handles = []
+    if shared:
+        handles = [lsm.LSM(filename)]
+        dbs = handles * nthreads
+    else:
+        handles = [lsm.LSM(filename) for _ in range(nthreads)]
+        dbs = handles
+
+    threads = [threading.Thread(target=reader,
+                                args=(dbs[i], nkeys, counts, i, stop))
+               for i in range(nthreads)]
+    worker = threading.Thread(target=maintenance,
+                              args=(filename, value_size, stop))
+    worker.start()
+    start = time.time()
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    worker.join()
+    for db in handles:
+        db.close()
+    return sum(counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--value-size', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=2.0)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, 'bench.ldb')
+        populate(filename, args.keys, args.value_size)
+        print('lsm extension: %s' % lsm.__file__)
+        print('%-8s %16s %16s' % ('threads', 'shared (ops/s)',
+                                  'per-thread (ops/s)'))
+        for nthreads in args.threads:
+            shared = run(filename, nthreads, args.keys, args.value_size,
+                         args.duration, True)
+            private = run(filename, nthreads, args.keys, args.value_size,
+                          args.duration, False)
+            print('%-8d %16d %16d' % (nthreads, shared, private))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,18 @@ else:
     cythonize = lambda obj: obj
 
 library_source = glob.glob('src/*.c')
+
+# Set LSM_LOG_WORK in the environment to build the library with its
+# diagnostic messages for flushes, merges and checkpoints (see
+# LSM.log_bridge).
+define_macros = []
+if os.environ.get('LSM_LOG_WORK'):
+    define_macros.append(('LSM_LOG_WORK', '1'))
+
 lsm_extension = Extension(
     'lsm',
-    sources=[python_source] + library_source)
+    sources=[python_source] + library_source,
+    define_macros=define_macros,
+    libraries=['z'])
 
 setup(name='lsm-db', ext_modules=cythonize([lsm_extension]))
@@ -5366,7 +5366,12 @@ int lsm_flush(lsm_db *db){
   }else{
     rc = lsmBeginWriteTrans(db);
     if( rc==LSM_OK ){
-      lsmFlushTreeToDisk(db);
+      /* The trees may only be discarded once they are on disk. If the
+      ** worker lock is held by another connection, LSM_BUSY is returned
+      ** and the trees are left as they are.  */
+      rc = lsmFlushTreeToDisk(db);
+    }
+    if( rc==LSM_OK ){
       lsmTreeDiscardOld(db);
       lsmTreeMakeOld(db);
       lsmTreeDiscardOld(db);
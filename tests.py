@@ -1,7 +1,13 @@
+import asyncio
+import hashlib
+import logging
+import operator
 import os
+import pickle
 import sys
 import tempfile
 import threading
+import time
 import unittest
 
 try:
@@ -17,6 +23,11 @@ def b(s):
     return s.encode('utf-8') if not isinstance(s, bytes) else s
 
 
+def len_records(records):
+    # Module-level, so that it can be sent to worker processes.
+    return sum(1 for _ in records)
+
+
 class BaseTestLSM(unittest.TestCase):
     def setUp(self):
         self.filename = tempfile.mktemp()
@@ -111,6 +122,197 @@ class TestLSM(BaseTestLSM):
         res = self.db.fetch_bulk(['foo', 'bar'])
         self.assertEqual(res, {})
 
+        # The keys may be produced by code using the same handle.
+        res = self.db.fetch_bulk(key for key, _ in self.db)
+        self.assertEqual(len(res), 4)
+        self.assertEqual(res[b'k4'], b'v4')
+        self.assertEqual(self.db.fetch_bulk(['k1', 'k22'], lsm.SEEK_GE),
+                         {'k1': b'v1', 'k22': b'v3'})
+
+    def test_insert_many(self):
+        n = self.db.insert_many(('k%02d' % i, 'v%s' % i) for i in range(25))
+        self.assertEqual(n, 25)
+        self.assertBEqual(self.db['k00'], 'v0')
+        self.assertBEqual(self.db['k24'], 'v24')
+
+        n = self.db.insert_many({'a': 'A', 'b': 'B'}, batch_size=1)
+        self.assertEqual(n, 2)
+        n = self.db.insert_many([('c', 'C'), ('d', 'D'), ('e', 'E')], 2)
+        self.assertEqual(n, 3)
+        self.assertEqual(self.db.insert_many([]), 0)
+        self.assertBEqual(list(self.db[:'e']), [
+            ('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', 'D'), ('e', 'E')])
+        self.assertEqual(self.db.transaction_depth, 0)
+
+        # Batches written before an error are kept, the current batch is
+        # rolled back.
+        def gen():
+            for i in range(5):
+                yield ('x%s' % i, 'X%s' % i)
+            raise ValueError('boom')
+        self.assertRaises(ValueError, self.db.insert_many, gen(), 3)
+        self.assertEqual(self.db.transaction_depth, 0)
+        self.assertBEqual(list(self.db.keys())[-3:], ['x0', 'x1', 'x2'])
+        self.assertMissing('x3')
+
+        # Nested inside an outer transaction.
+        with self.db.transaction() as txn:
+            self.db.insert_many([('y1', 'Y1'), ('y2', 'Y2')], 1)
+            txn.rollback()
+        self.assertMissing('y1')
+
+        self.assertRaises(ValueError, self.db.insert_many, [], 0)
+
+    def test_insert_many_threads(self):
+        # A write from another thread while a batch is being read is not
+        # part of the batch's transaction, so it survives the rollback.
+        def write():
+            self.db['z0'] = 'Z0'
+        def gen():
+            yield ('x0', 'X0')
+            t = threading.Thread(target=write)
+            t.start()
+            t.join()
+            raise ValueError('boom')
+        self.assertRaises(ValueError, self.db.insert_many, gen())
+        self.assertEqual(self.db.transaction_depth, 0)
+        self.assertMissing('x0')
+        self.assertBEqual(self.db['z0'], 'Z0')
+
+        def insert_many(prefix):
+            self.db.insert_many(('%s%04d' % (prefix, i), 'v')
+                                for i in range(2000))
+        threads = [threading.Thread(target=insert_many, args=(p,))
+                   for p in 'abcd']
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(list(self.db.keys())), 8001)
+
+    def test_exists(self):
+        self.db['k1'] = 'v1'
+        self.assertTrue(self.db.exists('k1'))
+        self.assertFalse(self.db.exists('k0'))
+        self.assertFalse(self.db.exists('k11'))
+
+    def test_cursor_cache(self):
+        self.db.close()
+        db = lsm.LSM(self.filename, cursor_cache=True)
+        self.assertTrue(db.cursor_cache)
+        db['k1'] = 'v1'
+        self.assertBEqual(db['k1'], 'v1')
+        self.assertTrue('k1' in db)
+        self.assertFalse('k2' in db)
+
+        # Writes made by this connection are visible.
+        db['k2'] = 'v2'
+        self.assertTrue('k2' in db)
+        self.assertEqual(db.fetch_bulk(['k1', 'k2', 'k3']),
+                         {'k1': b'v1', 'k2': b'v2'})
+        with db.transaction() as txn:
+            db['k3'] = 'v3'
+            self.assertBEqual(db['k3'], 'v3')
+            txn.rollback()
+            self.assertRaises(KeyError, lambda: db['k3'])
+        self.assertFalse('k3' in db)
+        del db['k2']
+        self.assertFalse('k2' in db)
+
+        # Work and checkpoints are not prevented by the cached cursor.
+        self.assertBEqual(db['k1'], 'v1')
+        db.flush()
+        db.work()
+        db.checkpoint(0)
+
+        # Writes from another connection are visible once the cache is
+        # cleared.
+        self.assertFalse('k4' in db)
+        with lsm.LSM(self.filename) as other:
+            other['k4'] = 'v4'
+        db.clear_cursor_cache()
+        self.assertBEqual(db['k4'], 'v4')
+
+        with db.cursor() as cursor:
+            self.assertBEqual(list(cursor.keys()), ['k1', 'k4'])
+
+        self.assertTrue('k1' in db)
+        self.assertTrue(db.close())
+
+        self.db = lsm.LSM(self.filename)
+        self.assertFalse(self.db.cursor_cache)
+
+    def test_bulk_load(self):
+        self.db.autoflush = 512
+        loader = self.db.bulk_load(
+            ('k%05d' % i, 'v%s' % i * 10) for i in range(5000))
+        self.assertEqual(loader.count, 5000)
+        self.assertTrue(loader.pages_written > 0)
+        self.assertBEqual(self.db['k00000'], 'v0' * 10)
+        self.assertBEqual(self.db['k04999'], 'v4999' * 10)
+        self.assertEqual(len(list(self.db.keys())), 5000)
+
+        # Options are restored afterwards.
+        self.assertEqual(self.db.autoflush, 512)
+        self.assertEqual(self.db.autowork, 1)
+        self.assertEqual(self.db.autocheckpoint, 2048)
+        self.assertEqual(self.db.transaction_log, 1)
+
+        with self.db.bulk_loading(batch_size=2) as loader:
+            loader.insert('x1', 'X1')
+            loader.insert('x1', 'X1-2')
+            loader.insert_many([('x2', 'X2'), ('x3', 'X3')])
+        self.assertEqual(loader.count, 4)
+        self.assertBEqual(self.db['x1'], 'X1-2')
+        self.assertBEqual(self.db['x3'], 'X3')
+
+        # Keys must be sorted. The batch in progress is rolled back.
+        def load_unsorted():
+            with self.db.bulk_loading() as loader:
+                loader.insert('z2', 'Z2')
+                loader.insert('z1', 'Z1')
+        self.assertRaises(ValueError, load_unsorted)
+        self.assertMissing('z2')
+        self.assertEqual(self.db.transaction_depth, 0)
+        self.assertEqual(self.db.autowork, 1)
+
+        with self.db.transaction():
+            self.assertRaises(ValueError, self.db.bulk_load, [])
+
+    def test_bulk_load_with_maintenance(self):
+        # The maintenance worker holds the worker lock while it merges, so
+        # the loader leaves the merging to it rather than failing.
+        worker = self.db.start_maintenance(interval=0.001, idle_flush=0.01)
+        try:
+            for n in range(3):
+                loader = self.db.bulk_load(
+                    (('k%d-%05d' % (n, i), 'v' * 100) for i in range(5000)),
+                    autoflush=64, batch_size=100)
+                self.assertEqual(loader.count, 5000)
+        finally:
+            worker.stop()
+        self.assertEqual(self.db.count_range(), 15000)
+        self.assertBEqual(self.db['k2-04999'], 'v' * 100)
+
+    def test_get_bulk(self):
+        self.db.update(dict(('k%02d' % i, 'v%s' % i) for i in range(0, 50, 2)))
+        keys = ['k10', 'k11', 'k00', 'k48', 'k49', 'a', 'z', 'k10', 'k02']
+        expected = [b'v10', None, b'v0', b'v48', None, None, None, b'v10',
+                    b'v2']
+        self.assertEqual(self.db.get_bulk(keys), expected)
+        self.assertEqual(self.db.get_bulk(keys, sort_keys=False), expected)
+
+        sentinel = object()
+        res = self.db.get_bulk(['k11', 'k12'], sentinel)
+        self.assertEqual(res, [sentinel, b'v12'])
+
+        exists = [value is not None for value in expected]
+        self.assertEqual(self.db.exists_bulk(keys), exists)
+        self.assertEqual(self.db.exists_bulk(keys, False), exists)
+
+        self.assertEqual(self.db.get_bulk([]), [])
+        self.assertEqual(self.db.exists_bulk([]), [])
+
     def assertIterEqual(self, i, expected):
         self.assertBEqual(list(i), expected)
 
@@ -259,6 +461,100 @@ class TestLSM(BaseTestLSM):
             ('k7', 'v7'),
         ])
 
+    def test_scan(self):
+        for i in range(10):
+            self.db['k%s' % i] = 'v%s' % i
+        self.db[''] = 'empty'
+
+        def scan(*args, **kwargs):
+            kwargs.setdefault('values', False)
+            return [key.decode('utf8') for key in self.db.scan(*args, **kwargs)]
+
+        self.assertEqual(scan('k2', 'k5'), ['k2', 'k3', 'k4', 'k5'])
+        self.assertEqual(scan('k2', 'k5', start_inclusive=False,
+                              end_inclusive=False), ['k3', 'k4'])
+        self.assertEqual(scan('k5', 'k2', reverse=True, end_inclusive=False),
+                         ['k5', 'k4', 'k3'])
+        self.assertEqual(scan('k5', 'k2'), [])
+        self.assertEqual(scan('k25', 'k5'), ['k3', 'k4', 'k5'])
+        self.assertEqual(scan(None, 'k1'), ['', 'k0', 'k1'])
+        self.assertEqual(scan('', ''), [''])
+        self.assertEqual(scan('', 'k1', start_inclusive=False), ['k0', 'k1'])
+        self.assertEqual(scan('k8'), ['k8', 'k9'])
+        self.assertEqual(scan('k1', reverse=True), ['k1', 'k0', ''])
+        self.assertEqual(scan(offset=3, limit=2), ['k2', 'k3'])
+        self.assertEqual(scan('k7', offset=5), [])
+        self.assertEqual(scan(limit=0), [])
+
+        self.assertEqual(list(self.db.scan('k1', 'k2')),
+                         [(b'k1', b'v1'), (b'k2', b'v2')])
+        self.assertEqual(list(self.db.scan('k1', 'k2', keys=False)),
+                         [b'v1', b'v2'])
+        self.assertEqual(list(self.db.scan('k1', 'k6', chunk_size=2,
+                                           values=False)),
+                         [[b'k1', b'k2'], [b'k3', b'k4'], [b'k5', b'k6']])
+        self.assertRaises(ValueError, self.db.scan, keys=False, values=False)
+        self.assertRaises(ValueError, self.db.scan, limit=-1)
+
+        # Paginate using resume tokens.
+        pages = []
+        token = None
+        while True:
+            it = self.db.scan('k0', 'k8', limit=3, keys=False, resume=token)
+            pages.append([value.decode('utf8') for value in it])
+            token = it.resume_token
+            if token is None:
+                break
+        self.assertEqual(pages, [['v0', 'v1', 'v2'], ['v3', 'v4', 'v5'],
+                                 ['v6', 'v7', 'v8']])
+
+        it = self.db.scan('k9', reverse=True, limit=4, chunk_size=2)
+        self.assertEqual(len(list(it)), 2)
+        self.assertEqual(it.resume_token, b'k5')
+        it = self.db.scan(reverse=True, limit=4, resume=it.resume_token)
+        self.assertEqual([key for key, _ in it], [b'k5', b'k4', b'k3', b'k2'])
+
+        # Exhausted iterators release their cursor.
+        self.assertTrue(self.db.close())
+
+    def test_prefix(self):
+        keys = [b'a', b'ab', b'ab\x00', b'abc', b'ab\xff', b'ab\xff\xff',
+                b'ac', b'b', b'\xff', b'\xff\x01', b'\xff\xff']
+        for key in keys:
+            self.db[key] = key
+
+        def prefix(p, **kwargs):
+            return list(self.db.prefix(p, values=False, **kwargs))
+
+        self.assertEqual(prefix(b'ab'), keys[1:6])
+        self.assertEqual(prefix(b'ab', reverse=True), keys[5:0:-1])
+        self.assertEqual(prefix(b'ab\xff'), keys[4:6])
+        self.assertEqual(prefix(b'ab\xff', reverse=True), keys[5:3:-1])
+        self.assertEqual(prefix(b'\xff'), keys[8:])
+        self.assertEqual(prefix(b'\xff', reverse=True), keys[:7:-1])
+        self.assertEqual(prefix(b'ab', limit=2), keys[1:3])
+        self.assertEqual(prefix(b''), keys)
+        self.assertEqual(prefix(b'x'), [])
+        self.assertEqual(list(self.db.prefix('ac')), [(b'ac', b'ac')])
+
+        self.assertEqual(self.db.count_prefix(b'ab'), 5)
+        self.assertEqual(self.db.count_prefix(b'\xff'), 3)
+        self.assertEqual(self.db.count_prefix(b''), len(keys))
+        self.assertEqual(self.db.count_prefix(b'x'), 0)
+        self.assertEqual(self.db.count_prefix(b'\xff\xff\xff'), 0)
+
+        self.db.delete_prefix(b'ab')
+        self.assertEqual(prefix(b''), [b'a', b'ac', b'b', b'\xff',
+                                       b'\xff\x01', b'\xff\xff'])
+        self.db.delete_prefix(b'\xff')
+        self.assertEqual(prefix(b''), [b'a', b'ac', b'b'])
+        self.db.delete_prefix(b'x')
+        self.db.delete_prefix(b'b')
+        self.assertEqual(prefix(b''), [b'a', b'ac'])
+        self.db.delete_prefix(b'')
+        self.assertEqual(prefix(b''), [])
+        self.db.delete_prefix(b'')
+
     def test_delete_range(self):
         for i in range(1, 10):
             self.db['k%s' % i] = 'v%s' % i
@@ -329,6 +625,35 @@ class TestLSM(BaseTestLSM):
             ('k1', 'v1'),
         ])
 
+    def test_chunked_iteration(self):
+        self.assertEqual(list(self.db.items(chunk_size=2)), [])
+        for i in range(300):
+            self.db['k%03d' % i] = 'v%03d' % i
+
+        keys = [b'k%03d' % i for i in range(300)]
+        values = [b'v%03d' % i for i in range(300)]
+        self.assertEqual(list(self.db), list(zip(keys, values)))
+        self.assertEqual(list(self.db.keys(True)), keys[::-1])
+        self.assertEqual(list(self.db.values()), values)
+
+        chunks = list(self.db.items(chunk_size=128))
+        self.assertEqual([len(chunk) for chunk in chunks], [128, 128, 44])
+        self.assertEqual(chunks[2][-1], (b'k299', b'v299'))
+        chunks = list(self.db.keys(reverse=True, chunk_size=250))
+        self.assertEqual(chunks, [keys[:49:-1], keys[49::-1]])
+        self.assertEqual(sum(self.db.values(chunk_size=7), []), values)
+
+        chunks = list(self.db.fetch_range('k010', 'k020', chunk_size=4))
+        self.assertEqual([len(chunk) for chunk in chunks], [4, 4, 3])
+        chunks = list(self.db.fetch_range('k020', 'k0105', chunk_size=4))
+        self.assertEqual(sum(chunks, []), list(zip(keys, values))[20:10:-1])
+
+        # Abandoned iterators close their cursors.
+        it = iter(self.db)
+        next(it)
+        it.close()
+        self.assertTrue(self.db.close())
+
     def test_incr(self):
         self.assertEqual(self.db.incr('i0'), 1)
         self.assertEqual(self.db.incr('i0'), 2)
@@ -472,6 +797,105 @@ class TestTransactions(BaseTestLSM):
         self.assertBEqual(self.db['k1'], 'v1')
         self.assertBEqual(self.db['k2'], 'v2')
 
+    def test_write_batch(self):
+        for key in 'abcdef':
+            self.db[key] = key.upper()
+
+        batch = lsm.WriteBatch()
+        batch.insert('x', '1')
+        batch['y'] = '2'
+        batch.delete('a')
+        del batch['b':'e']
+        self.assertEqual(list(batch), [
+            ('insert', b'x', b'1'),
+            ('insert', b'y', b'2'),
+            ('delete', b'a', None),
+            ('delete_range', b'b', b'e')])
+        other = lsm.WriteBatch()
+        other.update({'z': '3'})
+        batch += other
+        self.assertEqual(len(batch), 5)
+        self.assertEqual(batch.nbytes, 5 * 9 + 9)
+        self.assertRaises(ValueError, batch.merge, batch)
+
+        # Nothing is written until the batch is applied.
+        self.assertBEqual(list(self.db.keys()), ['a', 'b', 'c', 'd', 'e',
+                                                 'f'])
+        self.assertEqual(self.db.write(batch), 5)
+        self.assertBEqual(list(self.db.keys()), ['b', 'e', 'f', 'x', 'y',
+                                                 'z'])
+
+        # Inside a transaction, the batch becomes part of it.
+        batch.clear()
+        self.assertEqual((len(batch), batch.nbytes), (0, 0))
+        batch['n'] = 'new'
+        with self.db.transaction() as txn:
+            self.db.write(batch)
+            self.assertBEqual(self.db['n'], 'new')
+            txn.rollback(False)
+        self.assertMissing('n')
+
+        # Batches may be built by several threads at once.
+        batches = []
+
+        def build(i):
+            batch = lsm.WriteBatch()
+            for j in range(100):
+                batch['t%s-%03d' % (i, j)] = 'v'
+            batches.append(batch)
+
+        threads = [threading.Thread(target=build, args=(i,))
+                   for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        for batch in batches:
+            self.db.write(batch)
+        self.assertEqual(self.db.count_range('t', 'u'), 400)
+
+    def test_group_commit(self):
+        # The work hook runs while the first group is being committed, and
+        # holds it until the other threads have queued their batches.
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=1, autowork=False)
+        committer = self.db.group_commit(window=0.05, max_batch=4)
+        release = threading.Event()
+        self.db.set_work_hook(lambda: release.wait(5))
+        groups = []
+
+        def commit_thread(i):
+            with committer.transaction() as batch:
+                batch['k%s' % i] = 'v' * 2048
+            groups.append(i)
+
+        threads = [threading.Thread(target=commit_thread, args=(i,))
+                   for i in range(8)]
+        threads[0].start()
+        while self.db.work_signal.count == 0:
+            time.sleep(0.001)
+        [t.start() for t in threads[1:]]
+        while committer.stats()['pending'] < 7:
+            time.sleep(0.001)
+        release.set()
+        [t.join() for t in threads]
+        self.db.set_work_hook(None)
+        self.assertEqual(sorted(groups), list(range(8)))
+        self.assertEqual(self.db.count_range(), 8)
+
+        # The first batch was committed alone, then the others in groups
+        # of at most max_batch.
+        stats = committer.stats()
+        self.assertEqual(stats['commits'], 8)
+        self.assertEqual(stats['groups'], 3)
+        self.assertEqual(stats['max_group'], 4)
+
+        batch = lsm.WriteBatch()
+        batch['single'] = 'x'
+        self.assertEqual(committer.commit(batch), stats['groups'] + 1)
+        self.assertBEqual(self.db['single'], 'x')
+
+        with self.db.transaction():
+            self.assertRaises(ValueError, committer.commit, batch)
+        self.assertEqual(committer.stats()['errors'], 1)
 
 class TestCursors(BaseTestLSM):
     def setUp(self):
@@ -789,6 +1213,134 @@ class TestCursors(BaseTestLSM):
         self.assertBEqual(keys, list(reversed(t_keys)))
         self.assertBEqual(values, list(reversed(t_values)))
 
+    def test_fetch_many(self):
+        with self.db.cursor() as cursor:
+            self.assertBEqual(cursor.fetch_many(3), [
+                ('aa', 'aaa'), ('bb', 'bbb'), ('bbb', 'bbb')])
+            self.assertBEqual(cursor.key(), 'dd')
+            self.assertBEqual(cursor.fetch_many(2, keys=False),
+                              ['ddd', 'eee'])
+            self.assertBEqual(cursor.fetch_many(10, values=False),
+                              ['gg', 'zz'])
+            self.assertEqual(cursor.fetch_many(10), [])
+            self.assertRaises(ValueError, cursor.fetch_many, 1, None,
+                              False, False)
+
+            cursor.seek('bb', lsm.SEEK_GE)
+            self.assertBEqual(cursor.fetch_many(10, end='dd', values=False),
+                              ['bb', 'bbb', 'dd'])
+            self.assertBEqual(cursor.key(), 'ee')
+            self.assertEqual(cursor.fetch_many(10, end='dd'), [])
+
+        with self.db.cursor(True) as cursor:
+            self.assertBEqual(cursor.fetch_many(10, end='e', values=False),
+                              ['zz', 'gg', 'ee'])
+            self.assertBEqual(list(cursor), [
+                ('dd', 'ddd'), ('bbb', 'bbb'), ('bb', 'bbb'), ('aa', 'aaa')])
+
+    def test_views(self):
+        with self.db.cursor() as cursor:
+            cursor.seek('dd', lsm.SEEK_GE)
+            key = cursor.key_view()
+            value = cursor.value_view()
+            self.assertEqual(bytes(key), b'dd')
+            self.assertEqual(len(value), 3)
+            with memoryview(value) as buf:
+                self.assertTrue(buf.readonly)
+                self.assertEqual(buf.tobytes(), b'ddd')
+                self.assertEqual(hashlib.md5(buf).hexdigest(),
+                                 hashlib.md5(b'ddd').hexdigest())
+
+                # The cursor cannot move while a buffer is exported.
+                self.assertRaises(BufferError, cursor.next)
+
+            self.assertTrue(value.is_valid())
+            cursor.next()
+            self.assertFalse(value.is_valid())
+            self.assertRaises(ValueError, value.tobytes)
+            self.assertRaises(ValueError, memoryview, key)
+            self.assertEqual(cursor.value_view().tobytes(), b'eee')
+            view = cursor.value_view()
+
+        self.assertRaises(ValueError, len, view)
+
+
+class TestKeyCodec(BaseTestLSM):
+    def setUp(self):
+        super(TestKeyCodec, self).setUp()
+        self.db.close()
+        self.db = lsm.LSM(self.filename, key_codec='tuple')
+
+    def test_tuple_codec(self):
+        codec = lsm.TupleCodec()
+        keys = [None, b'', b'a\x00b', b'b', '', 'a', 'é', (), (None,),
+                (1, 'a'), (1, 'a', 0), (2,), -2 ** 70, -2 ** 64, -256, -1,
+                0, 1, 255, 256, 2 ** 63, 2 ** 70, float('-inf'), -1.5, -0.0,
+                0.0, 2.5, float('inf'), False, True]
+        # Wrapped, so that tuples are encoded as nested tuples.
+        encoded = [codec.encode((key,)) for key in keys]
+        self.assertEqual(sorted(encoded), encoded)
+        self.assertEqual([codec.decode(data) for data in encoded], keys)
+        self.assertEqual(codec.encode(('user', 1, (None, b'x'))),
+                         b'\x02user\x00\x15\x01\x05\x00\xff\x01x\x00\x00')
+        self.assertEqual(codec.encode(1), codec.encode((1,)))
+        self.assertRaises(TypeError, codec.encode, object())
+
+    def test_key_codec(self):
+        for i in (10, -3, 2, 2 ** 70, 1):
+            self.db[('user', i)] = str(i)
+        self.db[('user', 1.5)] = 'f'
+        self.db[('zone', 'a')] = 'z'
+        self.assertEqual(self.db.key_codec, 'tuple')
+
+        users = [('user', i) for i in (-3, 1, 2, 10, 2 ** 70)]
+        self.assertEqual(list(self.db.keys()),
+                         users + [('user', 1.5), ('zone', 'a')])
+        self.assertBEqual(self.db[('user', 10)], '10')
+        self.assertTrue(('user', 2) in self.db)
+        self.assertFalse(('user', 3) in self.db)
+        self.assertBEqual(self.db.fetch(('user', 3), lsm.SEEK_GE), '10')
+
+        # Ranges, prefixes and cursors work on the decoded keys.
+        self.assertEqual([k for k, _ in self.db[('user', 1):('user', 10)]],
+                         users[1:4])
+        self.assertEqual([k for k, _ in self.db[('user', 10):('user', 1)]],
+                         users[3:0:-1])
+        self.assertEqual(list(self.db.prefix(('user',), values=False)),
+                         users + [('user', 1.5)])
+        self.assertEqual(self.db.count_prefix('user'), 6)
+        page = self.db.scan(('user', 0), limit=2, keys=True, values=False)
+        self.assertEqual(list(page), users[1:3])
+        self.assertEqual(page.resume_token, ('user', 10))
+        self.assertEqual(list(self.db.scan(resume=page.resume_token,
+                                           limit=1, values=False)),
+                         [('user', 10)])
+        with self.db.cursor() as cursor:
+            cursor.seek(('user', 2), lsm.SEEK_GE)
+            self.assertEqual(cursor.key(), ('user', 2))
+            self.assertEqual(cursor.fetch_many(2, keys=True, values=False),
+                             users[2:4])
+            self.assertEqual(next(cursor), (('user', 2 ** 70), b'1180591620'
+                                            b'717411303424'))
+
+        del self.db[('user', 0):('user', 10)]
+        self.assertEqual(list(self.db.prefix('user', values=False)),
+                         users[:1] + users[3:] + [('user', 1.5)])
+        self.db.delete_prefix('user')
+        self.assertEqual(list(self.db.keys()), [('zone', 'a')])
+
+        batch = lsm.WriteBatch(key_codec='tuple')
+        batch[('user', 5)] = 'five'
+        self.db.write(batch)
+        self.assertBEqual(self.db[('user', 5)], 'five')
+        self.assertEqual(self.db.split_points(2), [('zone', 'a')])
+
+        db = pickle.loads(pickle.dumps(self.db))
+        self.assertEqual(db.key_codec, 'tuple')
+        self.assertBEqual(db[('zone', 'a')], 'z')
+        db.close()
+        self.assertRaises(ValueError, lsm.LSM, self.filename, key_codec='x')
+
 
 class TestLSMOptions(BaseTestLSM):
     def test_no_open(self):
@@ -850,6 +1402,73 @@ class TestLSMOptions(BaseTestLSM):
         self.assertBEqual(db2['k9'], 'v9')
         db2.close()
 
+    def test_compression(self):
+        self.db.close()
+        os.unlink(self.filename)
+
+        db = lsm.LSM(self.filename, compression='zlib')
+        self.assertEqual(db.compression, 'zlib')
+        self.assertEqual(db.compression_id(), lsm.COMPRESSION_EMPTY)
+
+        for i in range(100):
+            db['k%02d' % i] = 'v%s' % i * 100
+        self.assertBEqual(db['k42'], 'v42' * 100)
+
+        def set_compression():
+            db.compression = None
+        self.assertRaises(ValueError, set_compression)
+        db.close()
+
+        self.assertRaises(ValueError, lsm.LSM, self.filename,
+                          compression='foo')
+
+        db = lsm.LSM(self.filename, compression=lsm.COMPRESSION_ZLIB)
+        self.assertEqual(db.compression_id(), lsm.COMPRESSION_ZLIB)
+        self.assertEqual(len(list(db)), 100)
+        self.assertBEqual(db['k99'], 'v99' * 100)
+        db.close()
+
+        # The codec is selected automatically when the database is read.
+        db = lsm.LSM(self.filename)
+        self.assertEqual(db.compression, None)
+        self.assertBEqual(db['k99'], 'v99' * 100)
+        self.assertEqual(db.compression, 'zlib')
+        db['k100'] = 'v100'
+        db.close()
+
+        db = lsm.LSM(self.filename, compression='zlib-best')
+        self.assertEqual(len(list(db)), 101)
+        self.assertEqual(db.compression, 'zlib')
+        self.assertEqual(db.count_range('k10', 'k11'), 2)
+        self.assertRaises(ValueError, db.estimate_range)
+        db.close()
+
+    def test_register_compression(self):
+        self.db.close()
+        os.unlink(self.filename)
+
+        self.assertRaises(ValueError, lsm.register_compression,
+                          lsm.COMPRESSION_NONE, 'foo')
+        self.assertRaises(ValueError, lsm.register_compression,
+                          lsm.COMPRESSION_ZLIB, 'foo')
+        self.assertRaises(ValueError, lsm.register_compression, 200, 'zlib')
+        self.assertRaises(ValueError, lsm.register_compression, 200, 'foo',
+                          'bar')
+        self.assertRaises(ValueError, lsm.register_compression, 200, 'foo',
+                          level=10)
+
+        lsm.register_compression(200, 'zlib-fast', level=1)
+        db = lsm.LSM(self.filename, compression='zlib-fast')
+        for i in range(100):
+            db['k%02d' % i] = 'v%s' % i * 100
+        db.close()
+
+        db = lsm.LSM(self.filename)
+        self.assertEqual(db.compression_id(), 200)
+        self.assertBEqual(db['k42'], 'v42' * 100)
+        self.assertEqual(db.compression, 'zlib-fast')
+        db.close()
+
     def test_multithreading(self):
         def create_entries_thread(low, high):
             for i in range(low, high):
@@ -872,6 +1491,365 @@ class TestLSMOptions(BaseTestLSM):
         expected = ['k%02d' % i for i in range(80)]
         self.assertBEqual(keys, expected)
 
+    def test_busy_error(self):
+        other = lsm.LSM(self.filename)
+        self.db.begin()
+        self.db['k1'] = 'v1'
+        # Only one connection may write at a time.
+        with self.assertRaises(lsm.BusyError) as ctx:
+            other['k2'] = 'v2'
+        self.assertTrue(isinstance(ctx.exception, RuntimeError))
+        self.db.commit()
+        other['k2'] = 'v2'
+        other.close()
+        self.assertBEqual(self.db['k2'], 'v2')
+
+    def test_flush_while_busy(self):
+        # Flushing while another connection holds the worker lock raises
+        # BusyError, and must not drop the in-memory trees.
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16, autowork=False)
+        other = lsm.LSM(self.filename)
+        stop = threading.Event()
+
+        def introspect():
+            while not stop.is_set():
+                other.structure()
+
+        threads = [threading.Thread(target=introspect) for _ in range(3)]
+        [t.start() for t in threads]
+        try:
+            for i in range(200):
+                with self.db.transaction():
+                    for j in range(10):
+                        self.db['k%03d-%d' % (i, j)] = 'x' * 100
+                while True:
+                    try:
+                        self.db.flush()
+                    except lsm.BusyError:
+                        continue
+                    break
+        finally:
+            stop.set()
+            [t.join() for t in threads]
+            other.close()
+        self.assertEqual(self.db.count_range(), 2000)
+
+    def test_pool(self):
+        pool = lsm.LSMPool(self.filename, size=2)
+        # Only one connection may write at a time, others get Busy.
+        write_lock = threading.Lock()
+
+        def write_thread(low, high):
+            for i in range(low, high):
+                with pool.connection() as db:
+                    with write_lock:
+                        db['k%02d' % i] = 'v%s' % i
+                    # Nested checkouts return the handle already held.
+                    with pool.connection() as inner:
+                        self.assertTrue(inner is db)
+
+        threads = [threading.Thread(target=write_thread,
+                                    args=(i * 10, i * 10 + 10))
+                   for i in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertBEqual(list(self.db.keys()),
+                          ['k%02d' % i for i in range(80)])
+
+        stats = pool.stats()
+        self.assertEqual(stats['checkouts'], 80)
+        self.assertTrue(stats['opened'] <= 2)
+        self.assertEqual(stats['in_use'], 0)
+
+        # Open transactions are rolled back and handles with open cursors
+        # are not reused.
+        db = pool.checkout()
+        db.begin()
+        db['uncommitted'] = 'x'
+        pool.checkin(db)
+        self.assertMissing('uncommitted')
+        db = pool.checkout()
+        cursor = db.cursor()
+        pool.checkin(db)
+        stats = pool.stats()
+        self.assertEqual((stats['rolled_back'], stats['discarded']), (1, 1))
+        cursor.close()
+
+        # With every handle checked out, other threads wait for one.
+        waits = pool.stats()['waits']
+        held = pool.checkout()
+        release = threading.Event()
+
+        def hold_thread():
+            with pool.connection():
+                release.wait()
+
+        t = threading.Thread(target=hold_thread)
+        t.start()
+        while pool.stats()['in_use'] < 2:
+            time.sleep(0.001)
+        errors = []
+        waiter = threading.Thread(target=lambda: errors.append(
+            self.assertRaises(RuntimeError, pool.checkout, 0.01)))
+        waiter.start()
+        waiter.join()
+        release.set()
+        t.join()
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], waits + 1)
+        self.assertTrue(stats['max_wait'] >= 0.01)
+        pool.checkin(held)
+        pool.close()
+
+    def test_pickle(self):
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=512, cursor_cache=True)
+        self.db['k1'] = 'v1'
+
+        spec = self.db.spec
+        self.assertEqual(spec.filename, self.filename)
+        self.assertEqual(spec.options, {'autoflush': 512})
+        self.assertTrue(spec.cursor_cache)
+        self.assertEqual(pickle.loads(pickle.dumps(spec)), spec)
+        self.assertEqual(hash(spec.replace()), hash(spec))
+        self.assertNotEqual(spec.replace(readonly=True), spec)
+        self.assertRaises(ValueError, lsm.LSMSpec, self.filename, nope=1)
+
+        db = pickle.loads(pickle.dumps(self.db))
+        self.assertTrue(db is not self.db)
+        self.assertTrue(db.is_open)
+        self.assertEqual(db.autoflush, 512)
+        self.assertBEqual(db['k1'], 'v1')
+        db.close()
+        self.assertFalse(pickle.loads(pickle.dumps(db)).is_open)
+
+        with spec.replace(readonly=True).open() as db:
+            self.assertBEqual(db['k1'], 'v1')
+            self.assertEqual(db.compression_id(), lsm.COMPRESSION_EMPTY)
+
+    def test_reader_pool(self):
+        with self.db.transaction():
+            for i in range(1000):
+                self.db['k%04d' % i] = 'v%s' % i
+        self.db.flush()
+
+        with lsm.ReaderPool(self.filename, processes=2) as readers:
+            self.assertEqual(readers.spec.options,
+                             {'readonly': True, 'mmap': True})
+            self.assertBEqual(readers.fetch('k0001'), 'v1')
+            self.assertRaises(KeyError, readers.fetch, 'missing')
+            keys = ['k%04d' % i for i in range(0, 2000, 100)]
+            self.assertEqual(readers.fetch_bulk(keys, chunk_size=3),
+                             self.db.fetch_bulk(keys))
+            self.assertBEqual(readers.scan('k0010', 'k0011'),
+                              [('k0010', 'v10'), ('k0011', 'v11')])
+            self.assertEqual(
+                [len(records) for records in readers.scan_many(
+                    [('k0000', 'k0009'), ('k0100', 'k0104')])], [10, 5])
+            self.assertEqual(readers.parallel_scan(
+                len_records, reduce=operator.add), 1000)
+
+            # Later commits are visible to the readers.
+            self.db['new'] = 'value'
+            self.assertBEqual(readers.fetch('new'), 'value')
+
+    def test_multithreading_readers_and_worker(self):
+        for i in range(100):
+            self.db['k%02d' % i] = 'v%s' % i
+
+        errors = []
+
+        def read_thread(db):
+            try:
+                for _ in range(20):
+                    for i in range(100):
+                        self.assertBEqual(db['k%02d' % i], 'v%s' % i)
+                    self.assertEqual(len(list(db['k00':'k99'])), 100)
+            except Exception as exc:
+                errors.append(exc)
+
+        def work_thread():
+            with lsm.LSM(self.filename) as db:
+                for i in range(100, 300):
+                    db['w%03d' % i] = 'x' * 1024
+                db.flush()
+                db.work(1, 1024)
+                db.checkpoint(0)
+
+        # Readers share this handle, or use their own.
+        other = lsm.LSM(self.filename)
+        threads = [threading.Thread(target=read_thread, args=(db,))
+                   for db in (self.db, self.db, other, other)]
+        threads.append(threading.Thread(target=work_thread))
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        other.close()
+
+        self.assertEqual(errors, [])
+        self.assertBEqual(self.db['w299'], 'x' * 1024)
+
+    def test_maintenance(self):
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16)
+        worker = self.db.start_maintenance(interval=0.01, idle_flush=0.05,
+                                           checkpoint_kb=16)
+        self.assertFalse(self.db.autowork)
+        self.assertTrue(worker.is_running())
+        self.assertRaises(ValueError, self.db.start_maintenance)
+
+        for i in range(10):
+            with self.db.transaction():
+                for j in range(200):
+                    self.db['k%04d' % (i * 200 + j)] = 'x' * 100
+
+        # Wait for the worker to flush the live tree once writes stop.
+        for _ in range(200):
+            if self.db.tree_size() == (0, 0):
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.db.tree_size(), (0, 0))
+
+        stats = worker.stats()
+        self.assertTrue(stats['flushes'] > 0)
+        self.assertTrue(stats['kb_written'] > 0)
+        self.assertTrue(stats['checkpoints'] > 0)
+        self.assertEqual(stats['errors'], 0)
+
+        self.assertTrue(worker.stop())
+        self.assertFalse(worker.is_running())
+        self.assertFalse(worker.stop())
+        self.assertTrue(self.db.autowork)
+        self.assertEqual(len(list(self.db.keys())), 2000)
+
+        # Closing the handle stops the worker.
+        worker = self.db.start_maintenance()
+        self.db.close()
+        self.assertFalse(worker.is_running())
+
+    def test_maintenance_keeps_options(self):
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16)
+        spec = self.db.spec
+        self.assertFalse('autowork' in spec.options)
+
+        worker = self.db.start_maintenance(interval=0.01)
+        self.assertFalse(self.db.autowork)
+        self.assertEqual(self.db.spec, spec)
+        self.assertTrue(worker.stop())
+        self.assertTrue(self.db.autowork)
+        self.assertEqual(self.db.spec, spec)
+
+        self.db.autowork = False
+        spec = self.db.spec
+        worker = self.db.start_maintenance(interval=0.01)
+        self.assertEqual(self.db.spec, spec)
+        self.assertTrue(worker.stop())
+        self.assertFalse(self.db.autowork)
+        self.assertEqual(self.db.spec, spec)
+
+    def test_work_hook(self):
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16, autowork=False)
+        events = []
+        self.db.set_work_hook(lambda: events.append(1))
+        self.assertRaises(ValueError, self.db.set_work_hook, 'not callable')
+        signal = self.db.work_signal
+        self.assertEqual(signal.count, 0)
+        self.assertEqual(signal.wait(0, timeout=0.01), 0)
+
+        counts = []
+        ready = threading.Event()
+
+        def waiter():
+            seen = signal.count
+            ready.set()
+            while seen == 0:
+                seen = signal.wait(seen, timeout=5)
+            counts.append(seen)
+
+        threads = [threading.Thread(target=waiter) for _ in range(3)]
+        [t.start() for t in threads]
+        ready.wait()
+
+        # Once the live tree exceeds autoflush, each commit marks it old.
+        for i in range(200):
+            self.db['k%03d' % i] = 'x' * 100
+        [t.join() for t in threads]
+        self.assertEqual(len(counts), 3)
+        self.assertTrue(all(count > 0 for count in counts))
+        self.assertEqual(len(events), signal.count)
+
+        # Flushing writes a segment.
+        nevents = len(events)
+        self.db.work(1, 1024)
+        self.assertTrue(len(events) > nevents)
+        self.assertEqual(len(events), signal.count)
+
+        nevents = len(events)
+        self.db.set_work_hook(None)
+        self.db.flush()
+        self.assertEqual(len(events), nevents)
+        self.assertTrue(signal.count > len(events))
+
+    def test_work_hook_uses_handle(self):
+        # The callback runs once the handle lock is released, so it may
+        # call into the library through the same handle.
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16, autowork=False)
+        checkpoints = []
+        self.db.set_work_hook(
+            lambda: checkpoints.append(self.db.checkpoint(0)))
+        for i in range(200):
+            self.db['k%03d' % i] = 'x' * 100
+        self.db.flush()
+        while self.db.work(1, 1024):
+            pass
+        self.db.set_work_hook(None)
+        self.assertTrue(checkpoints)
+        self.assertTrue(any(checkpoints))
+
+    def test_log_bridge(self):
+        class Handler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.records = []
+
+            def emit(self, record):
+                self.records.append(record)
+
+        handler = Handler()
+        logger = logging.getLogger('lsm.tests')
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+
+        self.assertFalse(self.db.log_bridge)
+        self.db.close()
+        self.db = lsm.LSM(self.filename, log_bridge=True)
+        self.assertTrue(self.db.log_bridge)
+        other = lsm.LSM(self.filename)
+        self.assertFalse(other.log_bridge)
+        self.assertNotEqual(self.db.connection_id, other.connection_id)
+
+        for i in range(1000):
+            self.db['k%04d' % i] = 'x' * 100
+        self.db.flush()
+        self.db.work(1, 1024)
+        self.db.checkpoint(0)
+        other.flush()
+        other.close()
+
+        # Messages are only produced by builds with LSM_LOG_WORK set.
+        n = lsm.drain_log(logger)
+        self.assertEqual(len(handler.records), n)
+        for record in handler.records:
+            self.assertEqual(record.lsm_connection, self.db.connection_id)
+        self.assertEqual(lsm.drain_log(logger), 0)
+
+        self.db.log_bridge = False
+        self.assertFalse(self.db.log_bridge)
+        logger.removeHandler(handler)
+
 
 class TestLSMInfo(BaseTestLSM):
     def test_lsm_info(self):
@@ -899,6 +1877,340 @@ class TestLSMInfo(BaseTestLSM):
         self.assertEqual(r1, 0)  # Not sure why not increasing...
         self.assertEqual(c1, 0)
 
+    def test_structure(self):
+        self.assertEqual(self.db.structure(), [])
+        self.assertEqual(self.db.freelist(), [])
+        self.assertEqual(self.db.read_amplification(), 0)
+
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16, autowork=False)
+        for i in range(4):
+            with self.db.transaction():
+                for j in range(200):
+                    self.db['k%04d' % (j * 4 + i)] = 'x' * 100
+            self.db.flush()
+
+        levels = self.db.structure()
+        self.assertEqual(len(levels), 4)
+        for level in levels:
+            self.assertEqual(sorted(level), ['age', 'merging', 'segments'])
+            self.assertFalse(level['merging'])
+            segment, = level['segments']
+            self.assertEqual(sorted(segment),
+                             ['first', 'last', 'pages', 'root'])
+            self.assertTrue(segment['pages'] > 0)
+        self.assertEqual(self.db.read_amplification(), 4)
+        self.db['kx'] = 'x'
+        self.assertEqual(self.db.read_amplification(), 5)
+
+        regions = self.db.log_structure()
+        self.assertEqual(len(regions), 3)
+        self.assertTrue(any(end > start for start, end in regions))
+
+        # Merging everything into one segment frees the old blocks.
+        self.db.flush()
+        while self.db.work(1, 4096):
+            pass
+        self.db.checkpoint(0)
+        self.assertEqual(len(self.db.structure()), 1)
+        self.assertEqual(self.db.read_amplification(), 1)
+        freelist = self.db.freelist()
+        self.assertTrue(freelist)
+        for block, snapshot_id in freelist:
+            self.assertTrue(block > 0)
+            self.assertTrue(snapshot_id > 0)
+
+    def _while_merging(self, fn):
+        # Run fn repeatedly on this handle while another connection
+        # flushes and merges segments; neither side may fail. Introspection
+        # takes the worker lock for a moment, so the merging side retries
+        # when it is busy, as the maintenance worker does.
+        self.db.close()
+        self.db = lsm.LSM(self.filename, autoflush=16, autowork=False)
+        errors = []
+        done = threading.Event()
+
+        def retry(fn, *args):
+            while True:
+                try:
+                    return fn(*args)
+                except lsm.BusyError:
+                    time.sleep(0.001)
+
+        def work_thread():
+            try:
+                with lsm.LSM(self.filename, autoflush=16,
+                             autowork=False) as db:
+                    for i in range(8):
+                        with db.transaction():
+                            for j in range(300):
+                                db['k%05d' % (j * 8 + i)] = 'x' * 100
+                        retry(db.flush)
+                        while retry(db.work, 2, 64):
+                            pass
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                done.set()
+
+        worker = threading.Thread(target=work_thread)
+        worker.start()
+        calls = 0
+        try:
+            while not done.is_set() or calls < 10:
+                fn()
+                calls += 1
+        except Exception as exc:
+            errors.append(exc)
+        worker.join()
+        self.assertEqual(errors, [])
+
+    def test_structure_while_merging(self):
+        def check():
+            for level in self.db.structure():
+                self.assertTrue(level['segments'])
+            self.assertTrue(self.db.read_amplification() >= 0)
+
+        self._while_merging(check)
+        self.assertEqual(self.db.count_range(), 2400)
+
+    def test_stats(self):
+        self.assertFalse(self.db.collect_stats)
+        self.db['k0'] = 'v0'
+        self.assertEqual(self.db.stats()['insert']['count'], 0)
+
+        self.db.collect_stats = True
+        for i in range(10):
+            self.db['k%s' % i] = 'v%s' % i
+        self.assertBEqual(self.db['k1'], 'v1')
+        self.assertRaises(KeyError, lambda: self.db['kx'])
+        self.assertEqual(self.db.get_bulk(['k2', 'k3']), [b'v2', b'v3'])
+        del self.db['k9']
+        with self.db.cursor() as cursor:
+            cursor.seek('k5')
+        self.db.flush()
+        self.db.work()
+        self.db.checkpoint(0)
+
+        stats = self.db.stats()
+        self.assertEqual(sorted(stats), sorted([
+            'insert', 'fetch', 'seek', 'delete', 'commit', 'work',
+            'checkpoint', 'flush']))
+        self.assertEqual(stats['insert']['count'], 10)
+        self.assertEqual(stats['insert']['bytes'], 40)
+        self.assertEqual(stats['fetch']['count'], 4)
+        self.assertEqual(stats['fetch']['bytes'], 2 + 2 + 2 + 4 + 4)
+        self.assertEqual(stats['fetch']['errors'], 0)
+        self.assertEqual(stats['delete']['count'], 1)
+        self.assertEqual(stats['seek']['count'], 1)
+        self.assertEqual(stats['flush']['count'], 1)
+        self.assertEqual(stats['checkpoint']['count'], 1)
+        for op in stats.values():
+            self.assertEqual(sum(count for _, count in op['latency']),
+                             op['count'])
+        self.assertEqual(stats['insert']['latency'][-1][0], float('inf'))
+
+        text = lsm.prometheus_text({'main': self.db})
+        self.assertTrue('# TYPE lsm_operations_total counter\n' in text)
+        self.assertTrue('lsm_operations_total{db="main",connection="%s",'
+                        'op="insert"} 10\n' % self.db.connection_id in text)
+        self.assertTrue('lsm_operation_duration_seconds_bucket{db="main",'
+                        'connection="%s",op="insert",le="+Inf"} 10\n' %
+                        self.db.connection_id in text)
+        self.assertFalse('op="commit"' in text)
+        self.assertTrue('lsm_tree_size_kb{' in text)
+        self.assertEqual(text.count('# TYPE lsm_tree_size_kb gauge'), 1)
+
+        self.db.reset_stats()
+        self.assertEqual(self.db.stats()['insert']['count'], 0)
+
+    def test_prometheus_text_while_merging(self):
+        def check():
+            text = lsm.prometheus_text([self.db])
+            self.assertTrue('lsm_tree_size_kb{' in text)
+
+        self._while_merging(check)
+
+    def test_split_points(self):
+        self.assertEqual(self.db.split_points(4), [])
+        for i in range(1000):
+            self.db['k%06d' % i] = 'v'
+        # Only the in-memory tree holds data, so keys are sampled.
+        points = self.db.split_points(4)
+        self.assertEqual(len(points), 3)
+        self.assertEqual(points, sorted(points))
+
+        with self.db.transaction():
+            for i in range(1000, 40000):
+                self.db['k%06d' % i] = 'v' * 40
+        self.db.flush()
+        self.assertEqual(self.db.split_points(1), [])
+        points = self.db.split_points(4)
+        self.assertEqual(len(points), 3)
+        for point, expected in zip(points, (10000, 20000, 30000)):
+            self.assertTrue(abs(int(point[1:]) - expected) < 2000, point)
+        points = self.db.split_points(2, 'k010000', 'k020000')
+        self.assertEqual(len(points), 1)
+        self.assertTrue(b'k014000' < points[0] < b'k016000', points)
+
+        def count(records):
+            return sum(1 for _ in records)
+
+        self.assertEqual(self.db.parallel_scan(count, 4, reduce=max),
+                         max(self.db.parallel_scan(count, 4)))
+        self.assertEqual(self.db.parallel_scan(count, 4, reduce=operator.add),
+                         40000)
+        self.assertEqual(self.db.parallel_scan(
+            count, 3, 'k000100', 'k000200', reduce=operator.add), 101)
+        self.assertEqual(self.db.parallel_scan(
+            list, 2, 'k000010', 'k000013', values=False),
+            [[b'k000010', b'k000011'], [b'k000012', b'k000013']])
+
+    def test_split_points_while_merging(self):
+        def check():
+            points = self.db.split_points(4)
+            self.assertEqual(points, sorted(points))
+
+        self._while_merging(check)
+
+    def test_estimate_range(self):
+        self.assertEqual(self.db.estimate_range(), (0, 0))
+        self.assertEqual(self.db.count_range(), 0)
+
+        for i in range(2):
+            with self.db.transaction():
+                for j in range(i, 20000, 2):
+                    self.db['k%06d' % j] = 'v' * 40
+            self.db.flush()
+        self.db['k999999'] = 'in-memory'
+
+        self.assertEqual(self.db.count_range(), 20001)
+        self.assertEqual(self.db.count_range('k001000', 'k003000'), 2000)
+        self.assertEqual(self.db.count_range('k019990'), 11)
+        self.assertEqual(self.db.count_range(None, 'k000010'), 10)
+        self.assertEqual(self.db.count_range('k1', 'k0'), 0)
+
+        for start, end, count in ((None, None, 20000),
+                                  ('k001000', 'k003000', 2000),
+                                  ('k010000', None, 10000)):
+            nkeys, nbytes = self.db.estimate_range(start, end)
+            self.assertTrue(count * 0.8 < nkeys < count * 1.2, nkeys)
+            self.assertTrue(count * 40 < nbytes < count * 80, nbytes)
+        self.assertEqual(self.db.estimate_range('k1', 'k2'), (0, 0))
+
+    def test_estimate_range_empty_key(self):
+        # The first page starts with an empty key, whose value must not be
+        # mistaken for it.
+        self.db[''] = 'z' * 40
+        with self.db.transaction():
+            for i in range(2000):
+                self.db['k%04d' % i] = 'v' * 40
+        self.db.flush()
+        nkeys, nbytes = self.db.estimate_range(None, 'k0500')
+        self.assertTrue(400 < nkeys < 600, nkeys)
+        nkeys, nbytes = self.db.estimate_range('', 'k1000')
+        self.assertTrue(800 < nkeys < 1200, nkeys)
+
+    def test_estimate_range_while_merging(self):
+        def check():
+            nkeys, nbytes = self.db.estimate_range('k00100', 'k01000')
+            self.assertTrue(nkeys >= 0 and nbytes >= 0)
+
+        self._while_merging(check)
+
+
+class TestAsyncLSM(BaseTestLSM):
+    def test_async(self):
+        async def run():
+            async with lsm.AsyncLSM(self.filename, readers=2) as db:
+                # Writes made in the same iteration are committed together.
+                await asyncio.gather(*[db.insert('k%02d' % i, 'v%d' % i)
+                                       for i in range(20)])
+                self.assertEqual(await db.fetch('k03'), b'v3')
+                self.assertTrue(await db.exists('k19'))
+                self.assertEqual(await db.get('missing', 'd'), 'd')
+                with self.assertRaises(KeyError):
+                    await db.fetch('missing')
+
+                async with db.transaction() as txn:
+                    await txn.insert('t1', 'a')
+                    self.assertEqual(await txn.fetch('t1'), b'a')
+                    # Writes outside the transaction wait until it ends.
+                    deferred = asyncio.ensure_future(db.insert('x', 'y'))
+                    await asyncio.sleep(0.01)
+                    self.assertFalse(deferred.done())
+                await deferred
+
+                with self.assertRaises(ValueError):
+                    async with db.transaction() as txn:
+                        await txn.insert('t2', 'b')
+                        raise ValueError
+                self.assertEqual(await db.get('t1'), b'a')
+                self.assertEqual(await db.get('t2'), None)
+                self.assertEqual(await db.get('x'), b'y')
+
+                keys = [k async for k, _ in db.fetch_range('k05', 'k08')]
+                self.assertBEqual(keys, ['k05', 'k06', 'k07', 'k08'])
+
+                async with db.cursor() as cursor:
+                    cursor.chunk_size = 2
+                    await cursor.seek('k18', lsm.SEEK_GE)
+                    keys = [k async for k, _ in cursor]
+                self.assertBEqual(keys, ['k18', 'k19', 't1', 'x'])
+
+        asyncio.run(run())
+        self.assertBEqual(self.db['t1'], 'a')
+
+    def test_maintenance(self):
+        async def run():
+            async with lsm.AsyncLSM(self.filename, readers=1) as db:
+                # Maintenance runs after the writes of the same iteration,
+                # outside their transaction.
+                results = await asyncio.gather(
+                    db.insert('a', '1'), db.insert('b', '2'), db.flush(),
+                    db.insert('c', '3'))
+                self.assertEqual(results, [None, None, None, None])
+                self.assertEqual(await db.fetch('b'), b'2')
+
+                results = await asyncio.gather(
+                    db.insert('d', '4'), db.flush(), db.work(1, 1024),
+                    db.checkpoint())
+                self.assertEqual(results[:2], [None, None])
+                self.assertTrue(results[2] >= 0)
+                self.assertTrue(results[3] >= 0)
+
+                async with db.transaction() as txn:
+                    await txn.insert('e', '5')
+                    # Waits for the transaction to end.
+                    flushed = asyncio.ensure_future(db.flush())
+                    await asyncio.sleep(0.01)
+                    self.assertFalse(flushed.done())
+                await flushed
+                self.assertEqual(await db.fetch('e'), b'5')
+
+        asyncio.run(run())
+        self.assertEqual(self.db.count_range(), 5)
+
+    def test_open_cursors(self):
+        async def run():
+            async with lsm.AsyncLSM(self.filename, readers=1) as db:
+                await db.insert('k1', 'v1')
+                await db.insert('k2', 'v2')
+                iterator = db.fetch_range('k0', 'k9', chunk_size=1)
+                self.assertEqual(await iterator.__anext__(), (b'k1', b'v1'))
+
+                async with db.cursor() as cursor:
+                    await cursor.seek('k1')
+                    # Open cursors do not hide commits from other reads.
+                    await db.insert('new', 'x')
+                    self.assertEqual(await db.fetch('new'), b'x')
+
+                await iterator.close()
+                keys = [k async for k, _ in db.fetch_range('k0', 'k9')]
+                self.assertBEqual(keys, ['k1', 'k2'])
+
+        asyncio.run(run())
+
 
 if __name__ == '__main__':
     unittest.main(argv=sys.argv)